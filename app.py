@@ -1,22 +1,51 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import openai
 import time
-from supabase import create_client, Client
-from dotenv import load_dotenv
+from supabase import create_client, Client, ClientOptions
 import os
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 import secrets
-import json  # for JSON serialization
+import string
+import html
+import re
+import orjson
+import base64
+import hashlib
 import numpy as np
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from collections import OrderedDict
+import uuid
+import atexit
+import sqlite3
+from cachetools import LRUCache, TTLCache
+import zstandard as zstd
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+def _utcnow():
+    # Timezone-aware replacement for the deprecated datetime.utcnow()
+    return datetime.now(timezone.utc)
 
 # -------------------------------
 # CONFIG: Similarity threshold & embedding model
 # -------------------------------
 EMBEDDING_MODEL = "text-embedding-3-small"
 SIMILARITY_THRESHOLD = 0.65  # adjust up/down to be stricter/looser
+SEMANTIC_CACHE_THRESHOLD = 0.86  # stricter: reuses OpenAI answers for rewordings of past questions
+SEMANTIC_CACHE_SIZE = 1024
+MAX_QUESTION_TOKENS = 4000  # longer questions are truncated before reaching OpenAI
+OPENAI_CACHE_TTL = 30 * 24 * 60 * 60  # seconds an OpenAI answer stays in the on-disk cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OPENAI_CACHE_PATH = os.path.join(BASE_DIR, "openai_cache.sqlite3")
 
 # -------------------------------
 # BRAND COLORS & FONT
@@ -69,14 +98,35 @@ The AskTheBridge Team
 """
 
 # -------------------------------
-# SUPABASE CLIENT
+# SUPABASE & OPENAI CLIENTS
 # -------------------------------
 if not SUPABASE_URL or not SUPABASE_SERVICE_KEY or not OPENAI_API_KEY:
     st.error("Missing environment variables for Supabase or OpenAI.")
     st.stop()
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-openai.api_key = OPENAI_API_KEY
+# Cached so every rerun and session reuses the same pooled HTTP connections.
+# Shared by every session, so it is only used for service-key table access:
+# signing in on it would make every session's queries run as that user.
+@st.cache_resource(show_spinner=False)
+def get_supabase() -> Client:
+    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+
+def _auth_client() -> Client:
+    # Throwaway client for one auth call, so its session stays private
+    return create_client(
+        SUPABASE_URL,
+        SUPABASE_SERVICE_KEY,
+        options=ClientOptions(auto_refresh_token=False, persist_session=False),
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_openai() -> openai.OpenAI:
+    # The client retries 429s, 5xx and connection errors with exponential
+    # backoff and jitter, honouring Retry-After when the API sends it.
+    return openai.OpenAI(api_key=OPENAI_API_KEY, max_retries=3)
+
+supabase = get_supabase()
+openai_client = get_openai()
 
 # -------------------------------
 # PAGE CONFIG
@@ -86,8 +136,10 @@ st.set_page_config(page_title="AskTheBridge", page_icon="🛥️", layout="wide"
 # -------------------------------
 # CUSTOM CSS
 # -------------------------------
-st.markdown(f"""
-<style>
+# Formatted and minified once per process rather than on every rerun
+@st.cache_resource(show_spinner=False)
+def _css() -> str:
+    css = f"""
 html, body, [class*="css"] {{
     font-family: {PRIMARY_FONT};
     background-color: #FFFFFF;
@@ -183,37 +235,54 @@ div[data-testid="stHorizontalBlock"] > div {{
 div[data-testid="stVerticalBlock"] > div {{
     padding: 0 !important;
 }}
-</style>
-""", unsafe_allow_html=True)
+"""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)       # comments
+    css = re.sub(r"\s*([{}:;,>])\s*", r"\1", css)         # space around punctuation
+    css = re.sub(r"\s+", " ", css).strip()
+    return f"<style>{css}</style>"
+
+st.markdown(_css(), unsafe_allow_html=True)
 
 
 # -------------------------------
 # SESSION STATE INIT
 # -------------------------------
-if "page" not in st.session_state:
-    st.session_state.page = "login"
-if "logged_in" not in st.session_state:
-    st.session_state.logged_in = False
-if "username" not in st.session_state:
-    st.session_state.username = None
-if "users" not in st.session_state:
-    st.session_state.users = {}  # {email: [ { "title": ..., "messages": [...] }, ... ] }
-if "verification_codes" not in st.session_state:
-    st.session_state.verification_codes = {}
-if "password_reset_codes" not in st.session_state:
-    st.session_state.password_reset_codes = {}
-if "reset_step" not in st.session_state:
-    st.session_state.reset_step = 1
-if "partner_cache" not in st.session_state:
-    st.session_state.partner_cache = None
-if "current_chat_index" not in st.session_state:
-    st.session_state.current_chat_index = None
-if "feedback" not in st.session_state:
-    st.session_state.feedback = []
+for key, default in [
+    ("page", "login"),
+    ("logged_in", False),
+    ("username", None),
+    ("users", {}),  # {email: OrderedDict{chat_id: { "id": ..., "title": ..., "messages": [...] or None until opened }} }, oldest first
+    ("reset_step", 1),
+    ("partner_cache", None),
+    ("partner_cache_matrix", None),
+    ("current_chat_id", None),
+    ("chats_unloaded", 0),  # older DB chats not fetched yet
+    ("message_prefetch", {}),  # {chat_id: Future of its messages}, started at login
+    ("openai_followups", {}),  # {(chat_id, idx): "Ask OpenAI" reply already added for that message}
+    ("openai_inflight", set()),  # (chat_id, idx) of "Ask OpenAI" calls still running
+    ("feedback", []),
+]:
+    st.session_state.setdefault(key, default)
 
 # -------------------------------
 # EMAIL FUNCTIONS
 # -------------------------------
+# One authenticated SMTP connection per process instead of a new
+# connect + STARTTLS + login for every email. Sends share one lock, so the
+# timeout keeps a stalled server from blocking every session's emails.
+SMTP_TIMEOUT = 20  # seconds
+
+@st.cache_resource(show_spinner=False)
+def _smtp():
+    server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    server.starttls()
+    server.login(SMTP_USER, SMTP_PASS)
+    return server
+
+@st.cache_resource(show_spinner=False)
+def _smtp_lock():
+    return threading.Lock()
+
 def send_email(to_email, subject, body):
     try:
         msg = MIMEMultipart()
@@ -221,48 +290,86 @@ def send_email(to_email, subject, body):
         msg["To"] = to_email
         msg["Subject"] = subject
         msg.attach(MIMEText(body, "plain"))
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASS)
-        server.send_message(msg)
-        server.quit()
+        with _smtp_lock():
+            try:
+                try:
+                    _smtp().send_message(msg)
+                except smtplib.SMTPServerDisconnected:
+                    # Server dropped the idle connection; reconnect once
+                    _smtp.clear()
+                    _smtp().send_message(msg)
+            except OSError:
+                # Timed out or broken mid-send: don't reuse this connection
+                _smtp.clear()
+                raise
         return True
     except Exception as e:
         st.error(f"Failed to send email: {e}")
         return False
 
+VERIFICATION_CODE_TTL = 5 * 60  # seconds
+RESET_CODE_TTL = 10 * 60  # seconds
+MAX_CODE_ATTEMPTS = 5  # wrong guesses before a code is discarded
+
+# Pending codes live in process-wide TTL caches keyed by email as
+# [code, failed attempts]: expired entries are evicted automatically and
+# codes survive reruns and new tabs.
+# TTLCache isn't thread-safe (reads run expiry too), so each comes with a lock.
+@st.cache_resource(show_spinner=False)
+def _code_store(ttl):
+    return TTLCache(maxsize=10_000, ttl=ttl), threading.Lock()
+
+def _generate_code():
+    return "".join(secrets.choice(string.digits) for _ in range(6))
+
+def _save_code(ttl, email, code):
+    store, lock = _code_store(ttl)
+    with lock:
+        store[email] = [code, 0]
+
+def _check_code(ttl, email, code):
+    # Returns True, False (wrong code) or None (expired, missing or used up).
+    # A six-digit code is only safe against guessing because each one gets
+    # MAX_CODE_ATTEMPTS tries before it is thrown away.
+    store, lock = _code_store(ttl)
+    with lock:
+        entry = store.get(email)
+        if entry is None:
+            return None
+        if secrets.compare_digest((code or "").encode(), entry[0].encode()):
+            store.pop(email, None)
+            return True
+        entry[1] += 1
+        if entry[1] >= MAX_CODE_ATTEMPTS:
+            store.pop(email, None)
+        return False
+
 def send_verification_code(email):
-    code = secrets.token_hex(3)
-    expiry = datetime.utcnow() + timedelta(minutes=5)
-    st.session_state.verification_codes[email] = (code, expiry)
+    code = _generate_code()
+    _save_code(VERIFICATION_CODE_TTL, email, code)
     body = VERIFICATION_EMAIL_BODY.format(email=email, code=code)
     return send_email(email, VERIFICATION_EMAIL_SUBJECT, body)
 
 def send_password_reset_code(email):
-    code = secrets.token_hex(3)
-    expiry = datetime.utcnow() + timedelta(minutes=10)
-    st.session_state.password_reset_codes[email] = (code, expiry)
+    code = _generate_code()
+    _save_code(RESET_CODE_TTL, email, code)
     body = PASSWORD_RESET_EMAIL_BODY.format(email=email, code=code)
     return send_email(email, PASSWORD_RESET_EMAIL_SUBJECT, body)
 
 def verify_code(email, code):
-    if email in st.session_state.verification_codes:
-        saved_code, expiry = st.session_state.verification_codes[email]
-        if datetime.utcnow() > expiry:
-            return False, "Verification code expired"
-        if code == saved_code:
-            del st.session_state.verification_codes[email]
-            return True, "Verified"
+    result = _check_code(VERIFICATION_CODE_TTL, email, code)
+    if result is None:
+        return False, "Verification code expired or not found"
+    if result:
+        return True, "Verified"
     return False, "Invalid verification code"
 
 def verify_reset_code(email, code):
-    if email in st.session_state.password_reset_codes:
-        saved, expiry = st.session_state.password_reset_codes[email]
-        if datetime.utcnow() > expiry:
-            return False, "Reset code expired"
-        if code == saved:
-            del st.session_state.password_reset_codes[email]
-            return True, "Code verified"
+    result = _check_code(RESET_CODE_TTL, email, code)
+    if result is None:
+        return False, "Reset code expired or not found"
+    if result:
+        return True, "Code verified"
     return False, "Invalid reset code"
 
 # -------------------------------
@@ -270,7 +377,7 @@ def verify_reset_code(email, code):
 # -------------------------------
 def supabase_sign_up(email, password):
     try:
-        response = supabase.auth.sign_up({"email": email, "password": password})
+        response = _auth_client().auth.sign_up({"email": email, "password": password})
         if response.user:
             log_user_activity(email, "signup")
             return {"email": email}
@@ -286,7 +393,7 @@ def supabase_sign_in(email, password):
         st.error("Please provide both email and password.")
         return None
     try:
-        response = supabase.auth.sign_in_with_password({"email": email, "password": password})
+        response = _auth_client().auth.sign_in_with_password({"email": email, "password": password})
         if response.user:
             log_user_activity(email, "login")
             return {"email": email}
@@ -297,9 +404,28 @@ def supabase_sign_in(email, password):
         st.error(f"Sign in error: {e}")
         return None
 
+def _find_auth_user_id(admin, email):
+    # The admin API has no lookup by email, so page through the users
+    page = 1
+    while True:
+        users = admin.list_users(page=page, per_page=1000)
+        if not users:
+            return None
+        for user in users:
+            if user.email and user.email.casefold() == email.casefold():
+                return user.id
+        page += 1
+
 def supabase_update_password(email, new_password):
+    # Called once the reset code for `email` is verified; there is no signed
+    # in user, so the password is set through the admin API
     try:
-        response = supabase.auth.update_user({"password": new_password})
+        admin = _auth_client().auth.admin
+        user_id = _find_auth_user_id(admin, email)
+        if user_id is None:
+            st.error("No account found for this email.")
+            return False
+        response = admin.update_user_by_id(user_id, {"password": new_password})
         if response.user:
             log_user_activity(email, "password_reset")
             return True
@@ -310,305 +436,609 @@ def supabase_update_password(email, new_password):
         st.error(f"Error during password update: {e}")
         return False
 
+# Chat storage: user_chats has one row per chat (id, user_email, chat_title,
+# created_at, updated_at) and chat_messages one row per message (chat_id,
+# position, role, content, is_static), so a new turn only uploads its own
+# rows. Chats saved before that layout keep their history in
+# user_chats.messages (a plain list, or {"v": 1, "zstd": <base64>}) and are
+# copied into chat_messages the first time they are opened.
+# Chat titles are no longer unique per user (two tabs can each create
+# "Chat N"), so the old unique (user_email, chat_title) constraint has to go:
+#   alter table user_chats drop constraint user_chats_user_email_chat_title_key;
+def _decode_messages(stored):
+    if isinstance(stored, dict) and stored.get("v") == 1:
+        return orjson.loads(zstd.ZstdDecompressor().decompress(base64.b64decode(stored["zstd"])))
+    return stored or []
+
+def _message_row(chat_id, position, msg):
+    return {
+        "chat_id": chat_id,
+        "position": position,
+        "role": msg["role"],
+        "content": msg["content"],
+        "is_static": bool(msg.get("is_static_answer")),
+    }
+
+def _message_from_row(row):
+    msg = {"role": row["role"], "content": row["content"]}
+    if row["is_static"]:
+        msg["is_static_answer"] = True
+    return msg
+
+# Writes are queued and flushed in batches by a daemon thread so the rerun
+# never waits on a Supabase round-trip.
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 0.5  # seconds; a reply's saves usually coalesce into one upsert
+
+def _write_rows(table, rows):
+    if table == "user_chats":
+        supabase.table(table).upsert(rows, on_conflict="id").execute()
+    elif table == "chat_messages":
+        # Positions come from each session's copy of the chat, so the same
+        # chat open twice (or a legacy copy racing a second open) can repeat
+        # a position; the first row written wins instead of failing the batch
+        supabase.table(table).upsert(rows, on_conflict="chat_id,position", ignore_duplicates=True).execute()
+    else:
+        supabase.table(table).insert(rows).execute()
+
+def _flush_writes(batch):
+    rows_by_table = {}
+    for table, row in batch:
+        rows_by_table.setdefault(table, []).append(row)
+    if "user_chats" in rows_by_table:
+        # Keep only the latest version of each chat
+        rows_by_table["user_chats"] = list({row["id"]: row for row in rows_by_table["user_chats"]}.values())
+
+    # user_chats first: chat_messages rows reference the chat row
+    for table in sorted(rows_by_table, key=lambda t: t != "user_chats"):
+        rows = rows_by_table[table]
+        try:
+            _write_rows(table, rows)
+        except Exception:
+            # The batch mixes users and chats: retry one chat (or row) at a
+            # time so a bad row only loses its own chat's writes
+            groups = {}
+            for row in rows:
+                groups.setdefault(row.get("chat_id") or id(row), []).append(row)
+            for group in groups.values():
+                try:
+                    _write_rows(table, group)
+                except Exception as e:
+                    logger.error("Failed to write %d row(s) to %s: %s", len(group), table, e)
+
+def _write_flusher(write_queue):
+    while True:
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+        while len(batch) < WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_writes(batch)
+
+def _drain_writes(write_queue):
+    # Flush whatever is still queued when the server shuts down; the daemon
+    # flusher thread is killed without finishing its current window.
+    batch = []
+    while True:
+        try:
+            batch.append(write_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _flush_writes(batch)
+
+@st.cache_resource(show_spinner=False)
+def _get_write_queue():
+    write_queue = queue.Queue()
+    threading.Thread(target=_write_flusher, args=(write_queue,), daemon=True).start()
+    atexit.register(_drain_writes, write_queue)
+    return write_queue
+
 def log_user_activity(user_email, action):
-    try:
-        supabase.table("user_activity").insert({
-            "user_email": user_email,
-            "action": action,
-            "timestamp": datetime.utcnow().isoformat()
-        }).execute()
-    except Exception as e:
-        st.error(f"Failed to log activity: {e}")
+    _get_write_queue().put(("user_activity", {
+        "user_email": user_email,
+        "action": action,
+        "timestamp": _utcnow().isoformat()
+    }))
+
+def new_chat(title):
+    return {"id": str(uuid.uuid4()), "title": title, "messages": []}
+
+def index_chats(chats):
+    # Session chats are keyed by id, so the current chat survives chats
+    # being prepended, and lookups don't depend on list position
+    return OrderedDict((chat["id"], chat) for chat in chats)
+
+def append_messages_to_db(user_email, chat, new_messages):
+    # `new_messages` are the tail of chat["messages"]; only they are sent,
+    # plus a touch of the chat row so updated_at tracks activity
+    write_queue = _get_write_queue()
+    write_queue.put(("user_chats", {
+        "id": chat["id"],
+        "user_email": user_email,
+        "chat_title": chat["title"],
+        "updated_at": _utcnow().isoformat(),
+    }))
+    start = len(chat["messages"]) - len(new_messages)
+    for offset, msg in enumerate(new_messages):
+        write_queue.put(("chat_messages", _message_row(chat["id"], start + offset, msg)))
+
+CHAT_PAGE_SIZE = 50
+
+def _fetch_chat_titles(user_email, before=None):
+    # Titles of the most recently active chats (served by the
+    # (user_email, updated_at DESC) index), older than `before` when paging.
+    # Messages are left as None and fetched by load_chat_messages when the
+    # chat is opened. Paging by updated_at rather than by offset keeps pages
+    # stable while active chats move to the top.
+    # Returns (chats oldest-first, number of older chats not fetched yet).
+    # Touches no Streamlit state, so it is safe to run off the script thread.
+    query = supabase.table("user_chats").select("id, chat_title, updated_at", count="exact").eq("user_email", user_email)
+    if before is not None:
+        query = query.lt("updated_at", before)
+    resp = query.order("updated_at", desc=True).limit(CHAT_PAGE_SIZE).execute()
+    chats = [
+        {"id": row["id"], "title": row["chat_title"], "updated_at": row["updated_at"], "messages": None}
+        for row in reversed(resp.data)
+    ]
+    return chats, (resp.count or 0) - len(chats)
 
-def save_chat_to_db(user_email, chat):
+def load_chat_titles(user_email, before=None):
     try:
-        supabase.table("user_chats").upsert([{
-            "user_email": user_email,
-            "chat_title": chat["title"],
-            "messages": chat["messages"],
-            "updated_at": datetime.utcnow().isoformat(),
-        }], on_conflict="user_email,chat_title").execute()
+        return _fetch_chat_titles(user_email, before)
     except Exception as e:
-        st.error(f"Failed to save chat: {e}")
-
-def load_chats_from_db(user_email):
+        st.error(f"Failed to load chats: {e}")
+        return [], 0
+
+def _fetch_chat_messages(chat_id, write_queue):
+    # Raises on failure. Touches no Streamlit state (the write queue is
+    # resolved by the caller), so it can be prefetched off the script thread
+    resp = supabase.table("chat_messages").select("role, content, is_static").eq("chat_id", chat_id).order("position").execute()
+    if resp.data:
+        return [_message_from_row(row) for row in resp.data]
+
+    # Nothing in chat_messages yet: fall back to the pre-migration blob
+    # and copy it over so the next turn's positions line up
+    resp = supabase.table("user_chats").select("messages").eq("id", chat_id).limit(1).execute()
+    messages = _decode_messages(resp.data[0]["messages"]) if resp.data else []
+    for position, msg in enumerate(messages):
+        write_queue.put(("chat_messages", _message_row(chat_id, position, msg)))
+    return messages
+
+def load_chat_messages(chat_id):
+    # Uses the login prefetch for this chat if there is one
+    future = st.session_state.message_prefetch.pop(chat_id, None)
     try:
-        resp = supabase.table("user_chats").select("*").eq("user_email", user_email).order("created_at", {"ascending": True}).execute()
-        chats = []
-        for row in resp.data:
-            chats.append({
-                "title": row["chat_title"],
-                "messages": row["messages"]
-            })
-        return chats
+        return future.result() if future else _fetch_chat_messages(chat_id, _get_write_queue())
     except Exception as e:
-        st.error(f"Failed to load chats: {e}")
-        return []
+        st.error(f"Failed to load chat: {e}")
+        return None
 
 # -------------------------------
 # OPENAI / PARTNER LOGIC
 # -------------------------------
-@st.cache_data(show_spinner=False)
-def ask_openai_cached(question: str):
-    for attempt in range(3):
-        try:
-            response = openai.chat.completions.create(
-                model="gpt-4o-mini",
-                temperature=0.7,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant about yachting and technology."},
-                    {"role": "user", "content": question},
-                ],
+def _norm(s: str) -> str:
+    # Lookup key for questions: casefold is the Unicode-correct lower()
+    return s.strip().casefold()
+
+RATE_LIMIT_MESSAGE = "⚠️ The system is receiving too many requests right now. Please try again in a few seconds."
+CHAT_MODEL = "gpt-4o-mini"
+SYSTEM_PROMPT = "You are a helpful assistant about yachting and technology."
+
+# Answers persist in a local SQLite file so a restart or redeploy doesn't
+# re-pay OpenAI for questions it has already answered. It is only a cache:
+# if the file can't be opened, read or written, lookups miss and stores are
+# skipped.
+@st.cache_resource(show_spinner=False)
+def _openai_cache_db():
+    conn = sqlite3.connect(OPENAI_CACHE_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS openai_cache ("
+        "key TEXT PRIMARY KEY, answer TEXT NOT NULL, created_at REAL NOT NULL)"
+    )
+    conn.execute("DELETE FROM openai_cache WHERE created_at < ?", (time.time() - OPENAI_CACHE_TTL,))
+    conn.commit()
+    return conn, threading.Lock()
+
+def _prompt_key(question: str) -> str:
+    # Hash of the model, system prompt and normalized question, so a prompt
+    # or model change misses but a change of case doesn't
+    payload = orjson.dumps([CHAT_MODEL, SYSTEM_PROMPT, _norm(question)])
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def _lookup_openai_answer(key: str):
+    try:
+        conn, lock = _openai_cache_db()
+        with lock:
+            row = conn.execute(
+                "SELECT answer FROM openai_cache WHERE key = ? AND created_at >= ?",
+                (key, time.time() - OPENAI_CACHE_TTL),
+            ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning("OpenAI answer cache lookup failed: %s", e)
+        return None
+    return row[0] if row is not None else None
+
+def _store_openai_answer(key: str, answer: str):
+    try:
+        conn, lock = _openai_cache_db()
+        with lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO openai_cache (key, answer, created_at) VALUES (?, ?, ?)",
+                (key, answer, time.time()),
             )
-            return getattr(response.choices[0].message, "content", response.choices[0].message).strip()
-        except Exception as e:
-            err = str(e)
-            if "rate limit" in err.lower() or "429" in err:
-                time.sleep(5 * (attempt + 1))
-                continue
-            return f"⚠️ Error: {err}"
-    return "⚠️ The system is receiving too many requests right now. Please try again in a few seconds."
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.warning("OpenAI answer cache store failed: %s", e)
+
+def _chat_messages(question: str):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": question},
+    ]
+
+def _openai_answer(question: str) -> str:
+    # `question` is sent as typed; only the cache keys are normalized
+    key = _prompt_key(question)
+    answer = _lookup_openai_answer(key)
+    if answer is not None:
+        return answer
+
+    # Rate limits and transient failures are retried by the client itself
+    # (see get_openai), so anything raised here is final.
+    response = openai_client.chat.completions.create(
+        model=CHAT_MODEL,
+        temperature=0.7,
+        messages=_chat_messages(question),
+    )
+    answer = response.choices[0].message.content.strip()
+    _store_openai_answer(key, answer)
+    return answer
+
+@st.cache_resource(show_spinner=False)
+def _openai_answer_memo():
+    # The script is re-executed on every rerun, so the LRU lives in
+    # cache_resource to be shared by all reruns and sessions of the process.
+    # It sits in front of the SQLite cache inside _openai_answer, keyed by
+    # the normalized question.
+    return LRUCache(maxsize=1024), threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def _enc():
+    # o200k_base is the tokenizer used by gpt-4o-mini
+    return tiktoken.get_encoding("o200k_base")
+
+def _truncate_to_token_limit(text: str) -> str:
+    # o200k_base is byte-level BPE: every token covers at least one UTF-8
+    # byte (not character), so text this short in bytes can't be over
+    data = text.encode()
+    if len(data) <= MAX_QUESTION_TOKENS:
+        return text
+    try:
+        enc = _enc()
+    except Exception as e:
+        # The encoding is downloaded on first use; without it, a byte cut
+        # still stays under the limit
+        logger.warning("Tokenizer unavailable, truncating by bytes: %s", e)
+        return data[:MAX_QUESTION_TOKENS].decode(errors="ignore")
+    ids = enc.encode(text)
+    if len(ids) <= MAX_QUESTION_TOKENS:
+        return text
+    return enc.decode(ids[:MAX_QUESTION_TOKENS])
+
+def ask_openai_cached(question: str):
+    # Raises openai.RateLimitError / openai.APIError, which are never
+    # memoized, so callers can tell a failure from an answer.
+    question = _truncate_to_token_limit(question.strip())
+    memo, lock = _openai_answer_memo()
+    with lock:
+        answer = memo.get(_norm(question))
+    if answer is None:
+        answer = _openai_answer(question)
+        with lock:
+            memo[_norm(question)] = answer
+    return answer
+
+def _stream_openai_answer(question: str, key: str, query_embedding):
+    chunks = []
+    try:
+        stream = openai_client.chat.completions.create(
+            model=CHAT_MODEL,
+            temperature=0.7,
+            messages=_chat_messages(question),
+            stream=True,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunks[-1]
+    except openai.RateLimitError:
+        yield RATE_LIMIT_MESSAGE
+        return
+    except openai.APIError as e:
+        yield f"⚠️ Error: {e}"
+        return
+    # Only a completed answer is cached
+    answer = "".join(chunks).strip()
+    _store_openai_answer(key, answer)
+    if query_embedding is not None:
+        _semantic_cache_store(query_embedding, answer)
+
+def ask_openai_streamed(question: str, query_embedding=None):
+    # Like ask_openai_cached, but a question that isn't cached yet comes
+    # back as a generator of text chunks, so the reply can be shown as it
+    # is generated. A cached answer is returned as a plain str. With the
+    # question's embedding, a successful answer is also added to the
+    # semantic cache so rewordings of the same question hit it.
+    question = _truncate_to_token_limit(question.strip())
+    key = _prompt_key(question)
+    answer = _lookup_openai_answer(key)
+    if answer is None:
+        return _stream_openai_answer(question, key, query_embedding)
+    if query_embedding is not None:
+        _semantic_cache_store(query_embedding, answer)
+    return answer
 
 # -------------------------------
 # Embedding helpers
 # -------------------------------
-EMBEDDING_MODEL = "text-embedding-3-small"  # optional if using embeddings
-
 def compute_embedding(text: str):
     try:
-        return None
+        response = openai_client.embeddings.create(model=EMBEDDING_MODEL, input=[text])
+        vec = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vec / np.linalg.norm(vec)
     except Exception as e:
         st.warning(f"Embedding failed: {e}")
         return None
 
+# -------------------------------
+# Partner Q&A
+# -------------------------------
+# Q&A text ships as data/qa.json. build_partner_index.py can precompute the
+# normalized question embeddings into a .npy next to it; the file name
+# carries the model and a hash of the questions, so a model change or a
+# reworded question never reuses stale vectors. No .npy is committed, so
+# unless the script has been run, a cold start pays for one batched
+# embedding call.
+DATA_DIR = os.path.join(BASE_DIR, "data")
+PARTNER_QA_PATH = os.path.join(DATA_DIR, "qa.json")
+
+def _partner_embeddings_path(questions):
+    # Keep in sync with build_partner_index.py
+    digest = hashlib.blake2b("\n".join(questions).encode(), digest_size=8).hexdigest()
+    return os.path.join(DATA_DIR, f"qa_embeddings.{EMBEDDING_MODEL}.{digest}.npy")
+
+@st.cache_resource(show_spinner=False)
+def _load_partner_qa():
+    with open(PARTNER_QA_PATH, "rb") as f:
+        qa_pairs = orjson.loads(f.read())
+    # Shared by every session (load_partner_cache stores it by reference),
+    # so hand out a tuple that no session can append to
+    return tuple(qa_pairs)
+
+@st.cache_resource(show_spinner=False)
+def _build_partner_index():
+    qa_pairs = _load_partner_qa()
+    path = _partner_embeddings_path([qa["question"] for qa in qa_pairs])
+    if os.path.exists(path):
+        emb = np.load(path, mmap_mode="r")
+        return qa_pairs, np.ascontiguousarray(emb, dtype=np.float32)
+
+    # No precomputed matrix for these exact questions: embed every partner
+    # question in one batched call. Rows are L2-normalized so cosine
+    # similarity against a normalized query is a single matmul.
+    response = openai_client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=[qa["question"] for qa in qa_pairs],
+    )
+    emb = np.asarray([item.embedding for item in response.data], dtype=np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+    return qa_pairs, np.ascontiguousarray(emb)
+
 # -------------------------------
 # Load partner Q&A cache
 # -------------------------------
 def load_partner_cache():
     if st.session_state.partner_cache is None:
-        st.session_state.partner_cache = []
-
-        qa_pairs = [
-            {
-                "question": "My chief stew and chef are in conflict two days before a busy charter. How do I de-escalate this without taking sides or compromising service?",
-                "answer": "Speak to each individually first: listen, clarify facts, and separate emotion from concrete issues (menus, timing, storage, service style). "
-                          "Restate the shared mission: 'Our job for the next 7 days is to deliver a seamless guest experience; we can revisit personal frustrations after the trip.' "
-                          "Agree on minimum operating rules: service times, handover points, communication channel (e.g. one WhatsApp group, no side channels for ops). "
-                          "Put a simple, written charter schedule in place (service times, special events, provisioning deadlines) and confirm they both sign off. "
-                          "Monitor closely during the first 24 hours of charter and give specific positive feedback when collaboration works ('That breakfast turn-around was spot on, thanks to both of you.')."
-            },
-            {
-                "question": "My rotation and leave plan looked fine on paper, but every season I end up with either short-staffing or burnout. What’s a better way to plan rotations?",
-                "answer": "Start from guest program + maintenance, not from crew headcount: map peak periods, shipyard periods, crossings, owner weeks, and charters. "
-                          "Build a 12-month coverage matrix: for each month, define minimum safe manning by department (bridge, interior, deck, engineering, galley). "
-                          "Add buffer capacity around refit/yard and long crossings; these are the highest fatigue zones. "
-                          "Use rotation templates (e.g. 2:2, 3:1) but adapt per department; engineers and chefs often need different patterns than deck. "
-                          "Run a stress-test: mark months where >30–35% of the crew are 'new'—if that happens in peak guest periods, adjust hiring or contract dates."
-            },
-            {
-                "question": "We’re about to switch from private to charter under a different flag. What are the most common compliance pitfalls captains miss in that transition?",
-                "answer": "Safety equipment & certification: ensure all lifesaving appliances, fire systems and documentation match commercial requirements (not just private). "
-                          "ISM/ISPS documentation: verify Safety Management System, drills records, and security plans are current and aligned with the new flag/management company. "
-                          "Working/rest hours: move from 'owner-flexible' to strictly recorded MLC compliance; audit your last 3 months to avoid surprises at inspection. "
-                          "Crew qualifications: check each role’s minimum safe manning certificate and endorsements for commercial operation. "
-                          "Commercial paperwork: charter contracts, VAT handling, passenger limits – coordinate early with management, broker and legal so you’re aligned before the first charter."
-            },
-            {
-                "question": "Port State Control and flag inspectors always seem to find something different. How can I prepare for inspections in a way that’s consistent and less stressful for the crew?",
-                "answer": "Keep a simple inspection folder (digital + physical) with: certificates, last inspection report, corrective actions, crew lists, drills records and key checklists. "
-                          "Run internal mini-inspections monthly: focus on basic items—LSA, FFA, signage, doors/vents, muster lists, logbooks. "
-                          "Involve crew in the process: assign each head of department 3–5 common findings and make them responsible for 'owning' those areas. "
-                          "After each real inspection, run a short 'lessons learned' debrief and update your checklist; treat it as continuous improvement, not blame. "
-                          "Maintain a calm, transparent tone with inspectors; when they see the ship is organised and cooperative, inspections tend to be smoother."
-            },
-            {
-                "question": "Our planned maintenance system is up to date on paper, but we still get nasty surprises in-season (AC failures, sewage issues, stabilisers). What can we change?",
-                "answer": "Separate “compliance maintenance” (things you must log) from “reliability maintenance” (things that actually ruin a trip when they fail). "
-                          "Build a “Top 20 Critical Failures” list for your yacht (AC, sewage, stabilisers, generators, tenders, galley key equipment) and add extra inspections there. "
-                          "Use data from past seasons: which systems failed and when? Increase inspection frequency and spares holding for those items. "
-                          "Before peak season, run a Red Team walk-through with engineer + chief stew + deck: ask “What would ruin a guest day if it broke right now?” and act on it. "
-                          "Track not just completed tasks, but unplanned downtime; aim to reduce that season-on-season."
-            },
-            {
-                "question": "I’m choosing between several refit yards for a big paint and machinery job. Beyond the quote, what should I really look at?",
-                "answer": "Check yard track record with your size and type of vessel—ask for 2–3 recent captains you can speak to directly. "
-                          "Evaluate project management structure: is there a dedicated PM assigned, with clear communication routines and reporting formats? "
-                          "Assess logistics & location (flights, crew housing, visa, weather windows) and include those costs/risks in your comparison. "
-                          "Review quality control processes: acceptance criteria, warranty terms, and how disputes are handled. "
-                          "Visit if possible: walk the yard, look at housekeeping, safety culture and how work is organised; these soft signals often matter more than the brochure."
-            },
-            {
-                "question": "Owner wants a “different” Med season with fewer crowded ports and more unique anchorages, but we must stay safe and practical. How do I approach this?",
-                "answer": "Start with constraints: yacht draft/LOA, helicopter ops, guest ages, mobility, and any security concerns. "
-                          "Map secondary hubs within each region (e.g. alternatives to St Tropez/Capri/Mykonos) that still have decent provisioning and medical access. "
-                          "Use past AIS and port call data (yours and comparable yachts if available) to avoid patterns everyone else follows. "
-                          "Plan “hero moments” (1–2 special anchorages or off-grid stops) backed by solid weather and escape plans. "
-                          "Present the owner with 2–3 curated itineraries that balance uniqueness with realism—highlighting exactly why each feels different from a classic milk run."
-            },
-            {
-                "question": "We’re under pressure to reduce fuel burn but still maintain ambitious itineraries. What are some practical routing strategies I can use?",
-                "answer": "Optimise transit speeds: small reductions (e.g. from 14 to 11–12 knots) often save disproportionate fuel over a season. "
-                          "Plan shorter legs with more local clusters of experiences instead of long daily hops. "
-                          "Use weather and current routing to minimise head seas and adverse conditions where possible. "
-                          "Coordinate with the owner/charter broker early to align expectations: show a fuel-optimised itinerary vs a “max distance” one. "
-                          "Log fuel burn vs itinerary in a simple dashboard and share trends with the owner/management; this makes future compromises easier to negotiate."
-            },
-            {
-                "question": "We get very little information about guest preferences before charters. How can I still deliver a personalised experience without annoying the broker or PA?",
-                "answer": "Create a simple, visually appealing preference sheet that brokers actually want to forward—less text, more checkboxes and examples. "
-                          "Ask for categories rather than specifics: dietary limits, general food styles, activity level, nightlife vs quiet, kids vs adults focus. "
-                          "Prepare modular experiences: a few ready-to-go “themes” (wellness day, water sports day, local culture day, party night) you can adapt on the fly. "
-                          "Use the first 12–24 hours to quietly observe and adjust: meal portions, timing, music volume, favourite spots onboard. "
-                          "Debrief with the broker post-charter, sharing what worked well; over time, that builds a richer picture for repeat clients."
-            },
-            {
-                "question": "The owner’s friends often show up last-minute with no notice. How can I build flexibility into the program without burning out the crew?",
-                "answer": "Define a “surge plan” with your HoDs: what changes when guest count spikes (service style, turndown, menu complexity, tender schedule). "
-                          "Maintain a basic backup provisioning list with easy, high-quality options that can scale guest numbers quickly. "
-                          "Protect crew core rest hours by temporarily reducing non-critical tasks (deep detailing, non-urgent maintenance) during these spikes. "
-                          "Communicate clearly with the owner/PA about what can and can’t be done last-minute without compromising safety. "
-                          "After each event, review impact on crew fatigue and adjust your surge plan for next time."
-            },
-            {
-                "question": "Our operating budget is always blown by the end of the season, especially in maintenance and provisions. How can I make the numbers more predictable?",
-                "answer": "Break the budget into 4–6 clear buckets (fuel, port/marina, maintenance, provisions, crew, “owner requests”) with monthly caps. "
-                          "Track “unplanned” vs “planned” spend separately; unplanned is where you’ll find improvement opportunities. "
-                          "Use last 2–3 seasons’ actuals to build a more realistic baseline, then add a defined contingency (e.g. 10–15%) rather than pretending it won’t be used. "
-                          "Share a simple monthly one-pager with the owner/management: big spends, savings and reasons; that builds trust and makes future conversations easier. "
-                          "Make at least one small visible saving initiative per season (e.g. shorepower vs generators where feasible) and show the numbers."
-            },
-            {
-                "question": "Management is cutting the maintenance budget, but I’m worried we’ll pay more later. How do I argue this without sounding difficult?",
-                "answer": "Translate technical risk into owner-language: tie maintenance cuts directly to “chance of losing charter days” or “trip disruption risk.” "
-                          "Present scenarios: “If we defer X, probability of failure in season is roughly Y; cost of that failure (lost days + emergency yard time) is Z.” "
-                          "Identify low-impact cuts you can accept (cosmetics, non-critical upgrades) to show you’re being cooperative. "
-                          "Propose a phased plan: what you must do this year, what can safely be postponed, and what should be monitored closely. "
-                          "Keep the tone solution-oriented: “Here are 3 options; my professional recommendation is B.”"
-            },
-            {
-                "question": "My owner changes his mind frequently about plans and priorities. How do I manage this without constant chaos on board?",
-                "answer": "Introduce a simple planning rhythm: e.g. a weekly brief (written or call) where you confirm itinerary, key priorities and any constraints. "
-                          "Summarise decisions back to the owner/PA after each change: “To confirm, we now do X instead of Y, which means Z impact.” "
-                          "Internally, maintain a “stable core” (safety, maintenance, compliance) that doesn’t move, and treat rest as flexible. "
-                          "Build a reputation for being both adaptable and transparent: say “yes” when you can, and clearly explain trade-offs when you can’t. "
-                          "Document major changes in a simple log; this helps avoid blame later and supports your case in future discussions."
-            },
-            {
-                "question": "Management company and I don’t always see eye to eye. How do I keep the relationship constructive but protect the vessel’s interests?",
-                "answer": "Clarify roles and responsibilities in writing: who decides on what (crew, budget, routing, major works, vendors). "
-                          "Use a regular standing call (e.g. bi-weekly) with a fixed agenda: safety, operations, finance, owner feedback, upcoming decisions. "
-                          "When you disagree, separate facts, risks and opinions; propose options with pros/cons rather than “yes/no.” "
-                          "Copy in the right people (e.g. DPA, fleet manager) for issues that affect compliance and safety – that frames it as a professional concern. "
-                          "Keep your tone consistently calm and professional; over time, being the person who brings structured information and solutions increases your influence."
-            },
-            {
-                "question": "We had a black water failure during charter—nightmare. What can I implement so this never happens again during a guest trip?",
-                "answer": "Treat black water and grey water as “mission critical”: review design limits, tank capacities, pump redundancy and venting. "
-                          "Implement pre-charter stress tests: simulate full guest load, run all heads, showers and laundry to confirm flows are stable. "
-                          "Create usage guidelines for guests (discreet, elegant signage + crew script) to reduce abuse. "
-                          "Maintain a spares & tools kit specifically for sewage systems and ensure crew are trained to use it. "
-                          "Review with an external specialist after the season if failures persist; design fixes are often cheaper than repeated emergencies."
-            },
-            {
-                "question": "Our stabilisers have become the most unreliable part of the vessel. How do I decide whether to keep repairing or plan for a bigger upgrade?",
-                "answer": "Log every incident with date, sea state, mode, and impact on guest comfort; patterns matter. "
-                          "Discuss with OEM/service partner: ask for a clear view of expected life, known failure modes and upgrade paths. "
-                          "Cost out the last 2–3 seasons of call-outs, downtime and lost guest days versus an overhaul/upgrade. "
-                          "Consider future itinerary (more crossings? rougher seas?) when evaluating risk. "
-                          "Present management/owner with options (maintain vs major upgrade) including financial and operational implications."
-            },
-            {
-                "question": "I’m a first-time captain on a 50–60m. What are the first 3 systems or processes I should review in detail in my first 90 days?",
-                "answer": "Safety & compliance: SMS, muster lists, drills records, equipment certificates, and how crew actually behave in drills. "
-                          "Maintenance & critical systems: PMS setup, spares strategy, and condition of generators, stabilisers, sewage, AC and tenders. "
-                          "Crew structure & culture: rotations, handover quality, communication routines, and the captain–HoD leadership dynamic. "
-                          "Make a 90-day plan with 3–5 concrete improvements and review it with management/owner’s rep to align expectations."
-            },
-            {
-                "question": "Owner wants “more use” of the yacht but crew are already stretched. How do I safely increase days in use without losing people or breaking the boat?",
-                "answer": "Quantify current vs requested days in use and overlay maintenance windows; show where pressure points occur. "
-                          "Propose a phased increase (e.g. +20% days this year) and define what support changes are needed (extra crew, different rotations, bigger maintenance yard period). "
-                          "Use data from past seasons (unplanned downtime, sick days, crew turnover) as arguments, not feelings. "
-                          "Suggest “smart” extra use (shoulder seasons, off-peak charters) rather than stacking more into already crowded months. "
-                          "Agree in writing on minimum maintenance and rest periods that must remain untouched."
-            },
-            {
-                "question": "How can I use data from our operations to have better conversations with the owner about risk, cost and upgrades?",
-                "answer": "Start small: track 3–5 metrics consistently (days in use, unplanned downtime incidents, fuel burn, major unplanned costs, crew turnover). "
-                          "Present these visually in a simple quarterly one-pager. "
-                          "Use that sheet to frame conversations: “We did X days, had Y incidents, Z unplanned cost – here’s what I recommend for next season.” "
-                          "Link upgrade requests directly to those metrics (e.g. “If we upgrade X, we expect fewer incidents like Y, which cost us €…”). "
-                          "Over time, this shifts conversation from opinions to trend-based decisions."
-            },
-            {
-                "question": "We’re constantly reactive. Is there a simple operational rhythm I can install so the boat feels more in control and less firefighting?",
-                "answer": "Implement a weekly operations meeting with HoDs: last week’s key issues, coming week’s plan, risks and guest highlights. "
-                          "Add a monthly “big picture” review: budget, maintenance, crew wellbeing, upcoming refit or major changes. "
-                          "Use a shared action list (even a simple spreadsheet) with owners, deadlines and status so nothing is just “in someone’s head.” "
-                          "Reserve protected time in the calendar for drills, training and preventative checks – don’t let them be the first thing cancelled. "
-                          "Stick to this rhythm even in quiet times; consistency is what builds a less reactive culture."
-            }
-        ]
-
-        # Save to session_state
-        for pair in qa_pairs:
-            st.session_state.partner_cache.append({
-                "question": pair["question"],
-                "answer": pair["answer"],
-                "embedding": None
-            })
-
-load_partner_cache()
-STATIC_QA = {pair["question"].lower(): pair["answer"] for pair in st.session_state.partner_cache}
-
-def get_answer(user_input: str):
-    key = user_input.strip().lower()
-    if key in STATIC_QA:
-        return STATIC_QA[key]   # static answer
-    return ask_openai_cached(user_input)
+        try:
+            qa_pairs, emb = _build_partner_index()
+        except Exception as e:
+            st.warning(f"Embedding failed: {e}")
+            qa_pairs, emb = _load_partner_qa(), None
+
+        # References to the process-wide objects, not per-session copies;
+        # a failed build leaves the matrix as None for the rest of the session
+        st.session_state.partner_cache = qa_pairs
+        st.session_state.partner_cache_matrix = emb
+
+@st.cache_resource(show_spinner=False)
+def _static_qa() -> dict[str, str]:
+    return {_norm(pair["question"]): pair["answer"] for pair in _load_partner_qa()}
+
+@st.cache_resource(show_spinner=False)
+def _prefetch_pool():
+    # Shared by all sessions for independent network calls made at login
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="prefetch")
+
+# Before login nothing needs the partner cache; signing in prefetches it
+if st.session_state.logged_in:
+    load_partner_cache()
+STATIC_QA = _static_qa()
+
+def find_partner_answer(query):
+    # Cosine similarity of a normalized query embedding against every
+    # partner question in one float32 matrix-vector product.
+    matrix = st.session_state.partner_cache_matrix
+    if matrix is None:
+        return None
+    scores = matrix @ query
+    best = int(scores.argmax())
+    if scores[best] >= SIMILARITY_THRESHOLD:
+        return st.session_state.partner_cache[best]["answer"]
+    return None
 
 # -------------------------------
-# CHAT HANDLING AND RENDERING
+# Semantic answer cache
 # -------------------------------
+# Process-wide ring buffer of (question embedding, OpenAI answer) pairs, so a
+# reworded repeat of a question OpenAI already answered skips the API call.
+@st.cache_resource(show_spinner=False)
+def _semantic_cache():
+    return {"lock": threading.Lock(), "matrix": None, "answers": [None] * SEMANTIC_CACHE_SIZE, "count": 0, "next": 0}
+
+def _semantic_cache_lookup(query):
+    cache = _semantic_cache()
+    with cache["lock"]:
+        if cache["count"] == 0:
+            return None
+        scores = cache["matrix"][:cache["count"]] @ query
+        best = int(scores.argmax())
+        if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+            return cache["answers"][best]
+    return None
+
+def _semantic_cache_store(query, answer):
+    cache = _semantic_cache()
+    with cache["lock"]:
+        if cache["matrix"] is None:
+            cache["matrix"] = np.empty((SEMANTIC_CACHE_SIZE, query.shape[0]), dtype=np.float32)
+        slot = cache["next"]
+        cache["matrix"][slot] = query
+        cache["answers"][slot] = answer
+        cache["next"] = (slot + 1) % SEMANTIC_CACHE_SIZE
+        cache["count"] = min(cache["count"] + 1, SEMANTIC_CACHE_SIZE)
+
+def get_answer(user_input: str):
+    # Returns (answer, is_static_answer). Tries the exact partner question,
+    # then a paraphrased partner question, then a paraphrase of something
+    # OpenAI already answered, and only then OpenAI itself. A new OpenAI
+    # answer is a generator of text chunks; everything else is a str.
+    answer = STATIC_QA.get(_norm(user_input))
+    if answer is not None:
+        return answer, True
+    # Truncated like the OpenAI prompt; the embeddings endpoint rejects
+    # input over 8191 tokens
+    query = compute_embedding(_truncate_to_token_limit(user_input.strip()))
+    if query is None:
+        return ask_openai_streamed(user_input), False
+    answer = find_partner_answer(query)
+    if answer is not None:
+        return answer, True
+    answer = _semantic_cache_lookup(query)
+    if answer is not None:
+        return answer, False
+    return ask_openai_streamed(user_input, query_embedding=query), False
+
 # -------------------------------
 # CHAT HANDLING AND RENDERING
 # -------------------------------
-def render_chat(messages):
-    st.markdown('<div class="chat-container">', unsafe_allow_html=True)
+STATIC_ANSWER_ACTIONS = ["Ask a Specialist", "Ask Your Peers", "Ask on Instagram", "Ask OpenAI"]
 
-    for idx, msg in enumerate(messages):
-        if msg["role"] == "user":
-            st.markdown(f'<div class="chat-user">{msg["content"]}</div>', unsafe_allow_html=True)
+def _rerun_chat_area():
+    # A fragment interaction merged into a pending full-app rerun (e.g. Send
+    # right after a sidebar click) runs as part of the full script, where a
+    # fragment-scoped rerun is not allowed
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def _render_static_answer_actions(chat, idx, msg):
+    # The action buttons are only built while this answer's toggle is on,
+    # so a closed answer costs one widget per rerun instead of five.
+    # (A toggle rather than st.popover: popover bodies run even when closed.)
+    if not st.toggle("More options", key=f"actions_{chat['id']}_{idx}"):
+        return
+    cols = st.columns(4, gap="small")
+    for i, button_text in enumerate(STATIC_ANSWER_ACTIONS):
+        with cols[i]:
+            if st.button(button_text, key=f"{button_text}_{chat['id']}_{idx}"):
+                if button_text == "Ask OpenAI":
+                    # One reply per message: a double click (or a click
+                    # while the first call is still running) adds nothing
+                    key = (chat["id"], idx)
+                    if key in st.session_state.openai_followups or key in st.session_state.openai_inflight:
+                        continue
+                    # Only a successful reply is recorded, so a failed call
+                    # can be retried with another click
+                    st.session_state.openai_inflight.add(key)
+                    try:
+                        ai_response = ask_openai_cached(msg["content"])
+                    except openai.RateLimitError:
+                        st.warning(RATE_LIMIT_MESSAGE)
+                        continue
+                    except openai.APIError as e:
+                        st.error(f"⚠️ Error: {e}")
+                        continue
+                    finally:
+                        st.session_state.openai_inflight.discard(key)
+                    st.session_state.openai_followups[key] = ai_response
+                    # Append the AI response (messages are stored append-only)
+                    chat["messages"].append({"role": "bot", "content": ai_response})
+                    # Save the new message to DB
+                    append_messages_to_db(st.session_state.username, chat, chat["messages"][-1:])
+                    # Redraw the chat area so the reply shows up at the end
+                    _rerun_chat_area()
+                else:
+                    st.info(f"You clicked '{button_text}'")
+
+CHAT_WINDOW = 30  # messages rendered by default; older ones on request
+
+def _message_html(msg):
+    # Messages never change once added, so each is escaped and wrapped once
+    # and the result kept on the message (the DB row builder ignores it)
+    css_class = "chat-user" if msg["role"] == "user" else "chat-bot"
+    msg["_html"] = f'<div class="{css_class}">{html.escape(msg["content"])}</div>'
+    return msg["_html"]
+
+def _is_static_answer(msg):
+    return msg["role"] != "user" and msg.get("is_static_answer")
+
+def _chat_segments(chat):
+    # Consecutive messages go out as one HTML block (one Streamlit element);
+    # a block is only cut where a static answer needs its buttons underneath.
+    # The blocks are kept on the chat as [first, end, html] and only messages
+    # added since the last render are joined in, so a rerun doesn't rebuild
+    # the history.
+    messages = chat["messages"]
+    segments = chat.setdefault("_segments", [])
+    for idx in range(chat.get("_rendered_upto", 0), len(messages)):
+        msg = messages[idx]
+        msg_html = msg.get("_html") or _message_html(msg)
+        if segments and not _is_static_answer(messages[segments[-1][1] - 1]):
+            segments[-1][1] = idx + 1
+            segments[-1][2] += msg_html
         else:
-            st.markdown(f'<div class="chat-bot">{msg["content"]}</div>', unsafe_allow_html=True)
-
-            # Show static answer buttons only for static answers
-            if msg.get("is_static_answer"):
-                container = st.container()
-                with container:
-                    cols = st.columns(4, gap="small")
-                    buttons = ["Ask a Specialist", "Ask Your Peers", "Ask on Instagram", "Ask OpenAI"]
-                    for i, button_text in enumerate(buttons):
-                        with cols[i]:
-                            if st.button(button_text, key=f"{button_text}_{idx}"):
-                                if button_text == "Ask OpenAI":
-                                    # Call OpenAI only when button clicked
-                                    ai_response = ask_openai_cached(msg["content"])
-                                    # Insert new AI response right after the static answer
-                                    messages.insert(idx + 1, {"role": "bot", "content": ai_response})
-                                    # Save updated chat to DB
-                                    save_chat_to_db(
-                                        st.session_state.username,
-                                        {
-                                            "title": st.session_state.users[st.session_state.username][
-                                                st.session_state.current_chat_index
-                                            ]["title"],
-                                            "messages": messages
-                                        }
-                                    )
-                                else:
-                                    st.info(f"You clicked '{button_text}'")
-    st.markdown('</div>', unsafe_allow_html=True)
+            segments.append([idx, idx + 1, msg_html])
+    chat["_rendered_upto"] = len(messages)
+    return segments
+
+def render_chat(chat):
+    messages = chat["messages"]
+    # Only the last CHAT_WINDOW messages are rendered unless the user asks
+    # for the rest, so a rerun costs the same however long the chat is.
+    # (A toggle rather than st.expander: expander bodies run even when closed.)
+    start = max(len(messages) - CHAT_WINDOW, 0)
+    if start and st.toggle(f"Show {start} earlier messages", key=f"show_earlier_{chat['id']}"):
+        start = 0
+
+    for first, end, block in _chat_segments(chat):
+        if end <= start:
+            continue
+        if first < start:
+            # The window starts mid-block: rebuild just the visible part
+            block = "".join(msg["_html"] for msg in messages[start:end])
+        st.markdown(f'<div class="chat-container">{block}</div>', unsafe_allow_html=True)
+
+        # Show static answer buttons only for static answers
+        if _is_static_answer(messages[end - 1]):
+            _render_static_answer_actions(chat, end - 1, messages[end - 1])
 
 
 # UI: LOGIN / SIGNUP / VERIFICATION / RESET PAGES
@@ -627,12 +1057,30 @@ def show_login_page():
             if user:
                 st.session_state.logged_in = True
                 st.session_state.username = email
-                # Load chats
-                st.session_state.users[email] = load_chats_from_db(email)
-                # Set default chat index
-                if len(st.session_state.users[email]) == 0:
-                    st.session_state.users[email].append({"title": "Chat 1", "messages": []})
-                st.session_state.current_chat_index = 0
+                # The chat list and the partner index are independent, so
+                # they load in parallel; login waits for the slower one.
+                # Only plain network calls go to the pool: the partner index
+                # is in cache_resource, which needs the script thread.
+                pool = _prefetch_pool()
+                titles_future = pool.submit(_fetch_chat_titles, email)
+                load_partner_cache()
+                try:
+                    chats, unloaded = titles_future.result()
+                except Exception as e:
+                    st.error(f"Failed to load chats: {e}")
+                    chats, unloaded = [], 0
+                # Start on the opened chat's messages now; show_chat_page
+                # waits on them only after the sidebar has been drawn
+                if chats:
+                    st.session_state.message_prefetch = {
+                        chats[-1]["id"]: pool.submit(_fetch_chat_messages, chats[-1]["id"], _get_write_queue())
+                    }
+                if not chats:
+                    chats = [new_chat("Chat 1")]
+                st.session_state.users[email] = index_chats(chats)
+                st.session_state.chats_unloaded = unloaded
+                # Open the most recently active chat
+                st.session_state.current_chat_id = chats[-1]["id"]
                 st.session_state.page = "chat"
 
         st.button("Sign In", key="login_btn", on_click=login)
@@ -646,8 +1094,9 @@ def show_login_page():
             st.session_state.logged_in = True
             st.session_state.username = "Guest"
             if "Guest" not in st.session_state.users:
-                st.session_state.users["Guest"] = [{"title": "Chat 1", "messages": []}]
-            st.session_state.current_chat_index = 0
+                st.session_state.users["Guest"] = index_chats([new_chat("Chat 1")])
+            st.session_state.chats_unloaded = 0
+            st.session_state.current_chat_id = next(iter(st.session_state.users["Guest"]))
             st.session_state.page = "chat"
 
         st.button("Continue as Guest", key="guest_btn", on_click=guest_login)
@@ -728,51 +1177,63 @@ def show_reset_password_page():
 # -------------------------------
 # CHAT PAGE
 # -------------------------------
-def show_chat_page():
-    user_email = st.session_state.username
-    if user_email not in st.session_state.users:
-        st.session_state.users[user_email] = [{"title": "Chat 1", "messages": []}]
-    user_chats = st.session_state.users.get(user_email, [])
-
-    with st.sidebar:
-        st.markdown("### ⚙️ Chat Options")
-        if st.button("⬅️ Logout"):
-            st.session_state.page = "login"
-            st.session_state.logged_in = False
-            st.session_state.username = None
-            st.session_state.current_chat_index = None
-            st.stop()
-        if st.button("🆕 New Chat"):
-            new_title = f"Chat {len(user_chats) + 1}"
-            user_chats.append({"title": new_title, "messages": []})
-            st.session_state.current_chat_index = len(user_chats) - 1
-        st.markdown("### Previous Chats")
-        for idx, chat in enumerate(user_chats):
-            if st.button(chat["title"], key=f"chat_{idx}"):
-                st.session_state.current_chat_index = idx
-
-    if st.session_state.current_chat_index is None:
-        st.session_state.current_chat_index = 0
-
-    current_chat = user_chats[st.session_state.current_chat_index]
-
-    st.markdown(f"<p style='text-align:center;'>Logged in as: <b>{user_email}</b> | Chat: <b>{current_chat['title']}</b></p>", unsafe_allow_html=True)
-
-    placeholder_logos = [
-        "https://via.placeholder.com/150?text=Partner+1",
-        "https://via.placeholder.com/150?text=Partner+2",
-        "https://via.placeholder.com/150?text=Partner+3",
-        "https://via.placeholder.com/150?text=Partner+4"
-    ]
-
-    carousel_html = '<div class="carousel-container"><div class="carousel-track">'
-    for logo_url in placeholder_logos:
-        carousel_html += f'<img src="{logo_url}" alt="Partner logo">'
-    carousel_html += '</div></div>'
-    st.markdown(carousel_html, unsafe_allow_html=True)
-
+_PLACEHOLDER_LOGOS = [
+    "https://via.placeholder.com/150?text=Partner+1",
+    "https://via.placeholder.com/150?text=Partner+2",
+    "https://via.placeholder.com/150?text=Partner+3",
+    "https://via.placeholder.com/150?text=Partner+4"
+]
+
+# The script is re-executed on every rerun, so like _css() the markup is
+# built once in cache_resource rather than at module level
+@st.cache_resource(show_spinner=False)
+def _carousel_html():
+    return (
+        '<div class="carousel-container"><div class="carousel-track">'
+        + ''.join(f'<img src="{u}" alt="Partner logo">' for u in _PLACEHOLDER_LOGOS)
+        + '</div></div>'
+    )
+
+# The sidebar and the chat area are fragments: sending a message or clicking
+# a static-answer button reruns only the chat area, not the sidebar's loop
+# over every chat. Sidebar actions change what the main page shows, so they
+# trigger a full rerun.
+@st.fragment
+def _render_sidebar(user_email, user_chats):
+    st.markdown("### ⚙️ Chat Options")
+    if st.button("⬅️ Logout"):
+        st.session_state.page = "login"
+        st.session_state.logged_in = False
+        st.session_state.username = None
+        st.session_state.current_chat_id = None
+        st.rerun()
+    if st.button("🆕 New Chat"):
+        # Number after every chat, including older pages not loaded yet
+        new_title = f"Chat {st.session_state.chats_unloaded + len(user_chats) + 1}"
+        chat = new_chat(new_title)
+        user_chats[chat["id"]] = chat
+        st.session_state.current_chat_id = chat["id"]
+        st.rerun()
+    st.markdown("### Previous Chats")
+    if st.session_state.chats_unloaded > 0:
+        if st.button("Load older chats"):
+            oldest = next(iter(user_chats.values()))
+            older, unloaded = load_chat_titles(user_email, before=oldest["updated_at"])
+            for chat in reversed(older):
+                user_chats[chat["id"]] = chat
+                user_chats.move_to_end(chat["id"], last=False)
+            st.session_state.chats_unloaded = unloaded
+            st.rerun()
+    for chat_id, chat in user_chats.items():
+        if st.button(chat["title"], key=f"chat_{chat_id}"):
+            st.session_state.current_chat_id = chat_id
+            st.rerun()
+
+@st.fragment
+def _render_chat_area(user_email, current_chat):
     chat_container = st.container()
     input_container = st.container()
+    stream = None
 
     with input_container:
         with st.form(key="chat_form", clear_on_submit=True):
@@ -781,17 +1242,50 @@ def show_chat_page():
             submitted = cols[1].form_submit_button("Send")
             if submitted and user_input.strip() != "":
                 current_chat["messages"].append({"role": "user", "content": user_input.strip()})
-                key = user_input.strip().lower()
-                if key in STATIC_QA:
-                    answer = STATIC_QA[key]
-                    current_chat["messages"].append({"role": "bot", "content": answer, "is_static_answer": True})
+                answer, is_static = get_answer(user_input)
+                if not isinstance(answer, str):
+                    # Shown below the history as it arrives; the question is
+                    # saved now in case the stream is cut off
+                    stream = answer
+                    append_messages_to_db(user_email, current_chat, current_chat["messages"][-1:])
                 else:
-                    ai_response = ask_openai_cached(user_input.strip())
-                    current_chat["messages"].append({"role": "bot", "content": ai_response})
-                save_chat_to_db(user_email, {"title": current_chat["title"], "messages": current_chat["messages"]})
+                    if is_static:
+                        current_chat["messages"].append({"role": "bot", "content": answer, "is_static_answer": True})
+                    else:
+                        current_chat["messages"].append({"role": "bot", "content": answer})
+                    append_messages_to_db(user_email, current_chat, current_chat["messages"][-2:])
 
     with chat_container:
-        render_chat(current_chat["messages"])
+        render_chat(current_chat)
+        if stream is not None:
+            answer = st.write_stream(stream)
+            current_chat["messages"].append({"role": "bot", "content": answer.strip()})
+            append_messages_to_db(user_email, current_chat, current_chat["messages"][-1:])
+            # Redraw the area so the reply is rendered like the rest of the history
+            _rerun_chat_area()
+
+def show_chat_page():
+    user_email = st.session_state.username
+    if user_email not in st.session_state.users:
+        st.session_state.users[user_email] = index_chats([new_chat("Chat 1")])
+    user_chats = st.session_state.users[user_email]
+    if st.session_state.current_chat_id not in user_chats:
+        st.session_state.current_chat_id = next(iter(user_chats))
+
+    with st.sidebar:
+        _render_sidebar(user_email, user_chats)
+
+    current_chat = user_chats[st.session_state.current_chat_id]
+    if current_chat["messages"] is None:
+        current_chat["messages"] = load_chat_messages(current_chat["id"])
+        if current_chat["messages"] is None:
+            st.stop()  # error already shown; don't let a save overwrite the stored chat
+
+    st.markdown(f"<p style='text-align:center;'>Logged in as: <b>{user_email}</b> | Chat: <b>{current_chat['title']}</b></p>", unsafe_allow_html=True)
+
+    st.markdown(_carousel_html(), unsafe_allow_html=True)
+
+    _render_chat_area(user_email, current_chat)
 
 # -------------------------------
 # MAIN
@@ -0,0 +1,47 @@
+"""Precompute the partner question embeddings loaded by app.py.
+
+Run once after editing data/qa.json or changing EMBEDDING_MODEL:
+
+    python build_partner_index.py
+
+OPENAI_API_KEY is read from the environment (or a .env file).
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import openai
+from dotenv import load_dotenv
+
+EMBEDDING_MODEL = "text-embedding-3-small"  # keep in sync with app.py
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+PARTNER_QA_PATH = os.path.join(DATA_DIR, "qa.json")
+
+
+def partner_embeddings_path(questions):
+    # Keep in sync with app.py: the name carries a hash of the questions so
+    # the app never loads vectors for an edited qa.json
+    digest = hashlib.blake2b("\n".join(questions).encode(), digest_size=8).hexdigest()
+    return os.path.join(DATA_DIR, f"qa_embeddings.{EMBEDDING_MODEL}.{digest}.npy")
+
+
+def main():
+    load_dotenv()
+    with open(PARTNER_QA_PATH, encoding="utf-8") as f:
+        qa_pairs = json.load(f)
+
+    questions = [qa["question"] for qa in qa_pairs]
+    client = openai.OpenAI()
+    response = client.embeddings.create(model=EMBEDDING_MODEL, input=questions)
+    emb = np.asarray([item.embedding for item in response.data], dtype=np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+
+    path = partner_embeddings_path(questions)
+    np.save(path, emb)
+    print(f"Wrote {emb.shape[0]}x{emb.shape[1]} embeddings to {path}")
+
+
+if __name__ == "__main__":
+    main()